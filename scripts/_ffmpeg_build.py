@@ -0,0 +1,437 @@
+# Shared download, verification and build pipeline for the build-ffmpeg*
+# driver scripts.
+
+import asyncio
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import http.client
+import json
+import mmap
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import urllib.request
+
+from cibuildpkg import (
+    Builder,
+    Package,
+    When,
+    build_packages,
+    fast_copy,
+    get_platform,
+    log_group,
+    run,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+plat = platform.system()
+is_musllinux = plat == "Linux" and platform.libc_ver()[0] != "glibc"
+
+# resolved once instead of per tarball; matches Builder.source_dir
+source_dir = os.path.abspath("source")
+
+gperf_package = Package(
+    name="gperf",
+    source_url="http://ftp.gnu.org/pub/gnu/gperf/gperf-3.1.tar.gz",
+    sha256="588546b945bba4b70b6a3a616e80b4ab466e3f33024a352fc2198112cdbb3ae2",
+)
+
+
+def calculate_sha256(filename: str) -> str:
+    with open(filename, "rb") as f:
+        try:
+            # hash straight from the page cache, without copying into userspace
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return hashlib.sha256(mm).hexdigest()
+        except (OSError, ValueError):
+            # mmap is not usable here (e.g. Windows, empty file)
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, "sha256").hexdigest()
+            sha256_hash = hashlib.sha256()
+            for byte_block in iter(lambda: f.read(1 << 20), b""):
+                sha256_hash.update(byte_block)
+            return sha256_hash.hexdigest()
+
+
+def tarball_path(package: Package) -> str:
+    return os.path.join(source_dir, package.source_filename)
+
+
+def read_hash_sidecar(tarball: str) -> str | None:
+    """
+    Return the sha256 recorded for the tarball, if it is still valid.
+    """
+    try:
+        with open(tarball + ".sha256.ok") as f:
+            cached = json.load(f)
+        stat = os.stat(tarball)
+    except (OSError, ValueError):
+        return None
+    if (
+        cached.get("mtime_ns") == stat.st_mtime_ns
+        and cached.get("size") == stat.st_size
+    ):
+        return cached.get("sha256")
+    return None
+
+
+def write_hash_sidecar(tarball: str, sha: str) -> None:
+    stat = os.stat(tarball)
+    sidecar = tarball + ".sha256.ok"
+    with open(sidecar + ".tmp", "w") as f:
+        json.dump(
+            {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": sha}, f
+        )
+    os.replace(sidecar + ".tmp", sidecar)
+
+
+def download_and_hash(url: str, path: str) -> str:
+    # hash the HTTP body while writing it out, so the bytes cross RAM once
+    sha256_hash = hashlib.sha256()
+    with urllib.request.urlopen(url) as response, open(path, "wb") as f:
+        for chunk in iter(lambda: response.read(1 << 20), b""):
+            sha256_hash.update(chunk)
+            f.write(chunk)
+    return sha256_hash.hexdigest()
+
+
+def download_package(package: Package) -> str | None:
+    """
+    Download the package tarball if it is not cached.
+
+    Returns the sha256 of a freshly downloaded tarball, or None when a
+    cached tarball must be re-hashed separately.
+    """
+    tarball = tarball_path(package)
+
+    if not os.path.exists(tarball):
+        # stream into a partial file and only rename it into place once the
+        # body is complete, so an interrupted download cannot leave a
+        # truncated tarball that poisons the cache on the next run
+        partial = tarball + ".part"
+        try:
+            sha = download_and_hash(package.source_url, partial)
+            os.replace(partial, tarball)
+            return sha
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+
+    if not os.path.exists(tarball):
+        raise ValueError(f"tar bar doesn't exist: {tarball}")
+    return None
+
+
+async def _download_package_async(session, package: Package) -> str | None:
+    tarball = tarball_path(package)
+
+    if not os.path.exists(tarball):
+        # stream into a partial file and only rename it into place once the
+        # body is complete, so a failed download - or this task being
+        # cancelled when a sibling download fails - cannot leave a truncated
+        # tarball that poisons the cache on the next run
+        partial = tarball + ".part"
+        try:
+            sha256_hash = hashlib.sha256()
+            async with session.get(package.source_url) as response:
+                response.raise_for_status()
+                with open(partial, "wb") as f:
+                    async for chunk in response.content.iter_chunked(1 << 20):
+                        sha256_hash.update(chunk)
+                        f.write(chunk)
+            os.replace(partial, tarball)
+            return sha256_hash.hexdigest()
+        except (OSError, aiohttp.ClientError):
+            pass
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+
+    if not os.path.exists(tarball):
+        raise ValueError(f"tar bar doesn't exist: {tarball}")
+    return None
+
+
+async def _download_all(packages: list[Package]) -> dict:
+    # a shared session keeps connections alive across the many tarballs
+    # served from the same hosts
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=16)
+    ) as session:
+        hashes = await asyncio.gather(
+            *[_download_package_async(session, package) for package in packages]
+        )
+    return {package.name: sha for package, sha in zip(packages, hashes)}
+
+
+def verify_checksum(package: Package, sha: str) -> None:
+    if package.sha256 == sha:
+        print(f"{package.name} tarball: hashes match")
+    else:
+        raise ValueError(
+            f"sha256 hash of {package.name} tarball do not match!\nExpected: {package.sha256}\nGot: {sha}"
+        )
+
+
+def verify_package(package: Package) -> None:
+    tarball = tarball_path(package)
+
+    sha = calculate_sha256(tarball)
+    verify_checksum(package, sha)
+    write_hash_sidecar(tarball, sha)
+
+
+def _wait_all(future_to_package: dict) -> dict:
+    results = {}
+    for future in concurrent.futures.as_completed(future_to_package):
+        name = future_to_package[future]
+        try:
+            results[name] = future.result()
+        except Exception as exc:
+            print(f"{name} generated an exception: {exc}")
+            raise
+    return results
+
+
+def download_tars(packages: list[Package]) -> None:
+    # downloads are network-bound, hashing is CPU-bound: fetch everything
+    # concurrently, then hash whatever remains
+    if aiohttp is not None:
+        fresh_hashes = asyncio.run(_download_all(packages))
+    else:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            fresh_hashes = _wait_all(
+                {
+                    executor.submit(download_package, package): package.name
+                    for package in packages
+                }
+            )
+
+    # freshly downloaded tarballs were hashed while streaming to disk, and
+    # cached tarballs with a valid sidecar were hashed on a previous run;
+    # only the remaining cached tarballs need to be read again
+    cached_packages = []
+    for package in packages:
+        tarball = tarball_path(package)
+        sha = fresh_hashes[package.name]
+        if sha is not None:
+            verify_checksum(package, sha)
+            write_hash_sidecar(tarball, sha)
+        elif read_hash_sidecar(tarball) == package.sha256:
+            print(f"{package.name} tarball: hashes match (cached)")
+        else:
+            cached_packages.append(package)
+
+    if cached_packages:
+        # two hashing threads in one process: OpenSSL releases the GIL for
+        # each update, the streams interleave on the CPU's SHA units, and
+        # unlike worker processes they share this process's page cache
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            _wait_all(
+                {
+                    executor.submit(verify_package, package): package.name
+                    for package in cached_packages
+                }
+            )
+
+
+def enable_compiler_cache() -> None:
+    """
+    Route compiler invocations through ccache (or sccache) when available,
+    so unchanged translation units are reused across CI runs.
+    """
+    launcher = next(filter(shutil.which, ["ccache", "sccache"]), None)
+    if launcher is None:
+        return
+
+    print(f"using compiler cache: {launcher}")
+    os.environ["CC"] = f"{launcher} " + os.environ.get("CC", "gcc")
+    os.environ["CXX"] = f"{launcher} " + os.environ.get("CXX", "g++")
+
+    # cmake (>= 3.17) ignores a multi-word CC, but picks the launcher up
+    # from the environment for every project
+    os.environ["CMAKE_C_COMPILER_LAUNCHER"] = launcher
+    os.environ["CMAKE_CXX_COMPILER_LAUNCHER"] = launcher
+
+
+def build_ffmpeg(
+    *,
+    dest_dir: str,
+    community: bool,
+    packages: list[Package],
+    nasm_package: Package,
+) -> None:
+    """
+    Download, verify, build and package the given packages, the last of
+    which is expected to be FFmpeg itself.
+    """
+    # CI log output goes to a pipe; fully buffer it so progress messages are
+    # batched into large writes instead of one syscall per line, and rely on
+    # log_group flushing at group boundaries
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
+    sys.stderr.reconfigure(line_buffering=False, write_through=False)
+
+    output_dir = os.path.abspath("output")
+    if plat == "Linux" and os.environ.get("CIBUILDWHEEL") == "1":
+        output_dir = "/output"
+    output_tarball = os.path.join(output_dir, f"ffmpeg-{get_platform()}.tar.gz")
+
+    if os.path.exists(output_tarball):
+        print(f"output tarball {output_tarball} already exists, nothing to do")
+        return
+
+    builder = Builder(dest_dir=dest_dir)
+    builder.create_directories()
+    enable_compiler_cache()
+
+    # install packages
+    available_tools = set()
+    mingw_bindir = None
+    if plat == "Windows":
+        available_tools.update(["gperf", "nasm"])
+
+        # print tool locations; shutil.which walks PATH in-process instead
+        # of spawning `where` once per tool
+        print("PATH", os.environ["PATH"])
+        tool_paths = {
+            tool: shutil.which(tool)
+            for tool in ["gcc", "g++", "curl", "gperf", "ld", "nasm", "pkg-config"]
+        }
+        for tool, path in tool_paths.items():
+            print(f" - {tool}: {path}")
+        mingw_bindir = os.path.dirname(tool_paths["gcc"])
+
+    with log_group("install python packages"):
+        run(["pip", "install", "aiohttp", "cmake==3.31.6", "meson", "ninja"])
+
+    # the module-level aiohttp import ran before pip could install it;
+    # retry now so download_tars below gets the shared-session path
+    global aiohttp
+    if aiohttp is None:
+        with contextlib.suppress(ImportError):
+            import aiohttp
+
+    # build tools
+    build_tools = []
+    if "gperf" not in available_tools:
+        build_tools.append(gperf_package)
+
+    if "nasm" not in available_tools and platform.machine() not in {"arm64", "aarch64"}:
+        build_tools.append(nasm_package)
+
+    allowed_when = {
+        When.always,
+        When.community_only if community else When.commercial_only,
+    }
+    filtered_packages = [
+        package for package in packages if package.when in allowed_when
+    ]
+
+    download_tars(build_tools + filtered_packages)
+    for tool in build_tools:
+        builder.build(tool, for_builder=True)
+
+    # FFmpeg itself comes last and links against all the other libraries;
+    # everything before it only depends on what `requires` says, so those
+    # packages can build concurrently
+    build_packages(builder, filtered_packages[:-1])
+    builder.build(filtered_packages[-1])
+
+    if plat == "Windows":
+        # fix .lib files being installed in the wrong directory
+        for name in (
+            "avcodec",
+            "avdevice",
+            "avfilter",
+            "avformat",
+            "avutil",
+            "postproc",
+            "swresample",
+            "swscale",
+        ):
+            if os.path.exists(os.path.join(dest_dir, "bin", name + ".lib")):
+                # bin and lib live on the same volume, so this is a pure rename
+                os.replace(
+                    os.path.join(dest_dir, "bin", name + ".lib"),
+                    os.path.join(dest_dir, "lib", name + ".lib"),
+                )
+
+        # copy some libraries provided by mingw; hardlink when both
+        # directories are on the same volume, which avoids copying the bytes
+        for name in (
+            "libgcc_s_seh-1.dll",
+            "libiconv-2.dll",
+            "libstdc++-6.dll",
+            "libwinpthread-1.dll",
+            "zlib1.dll",
+        ):
+            src = os.path.join(mingw_bindir, name)
+            dst = os.path.join(dest_dir, "bin", name)
+            try:
+                os.link(src, dst)
+            except OSError:
+                fast_copy(src, dst)
+
+    # find libraries via the artifact manifest recorded per build, which
+    # also keeps the MinGW runtime DLLs imported above out of the strip pass
+    if plat == "Darwin":
+        library_glob = os.path.join(dest_dir, "lib", "*.dylib")
+    elif plat == "Windows":
+        library_glob = os.path.join(dest_dir, "bin", "*.dll")
+    else:
+        library_glob = os.path.join(dest_dir, "lib", "*.so")
+    library_suffix = library_glob.rsplit("*", 1)[-1]
+
+    libraries = sorted({f for f in builder.artifacts if f.endswith(library_suffix)})
+    if not libraries:
+        # every package came from a cached dest_dir; scan it instead
+        libraries = glob.glob(library_glob)
+
+    # strip libraries, one process per file so independent files run in parallel
+    strip_command = ["strip", "-S"] if plat == "Darwin" else ["strip", "-s"]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=os.cpu_count()
+    ) as executor:
+        list(executor.map(lambda library: run(strip_command + [library]), libraries))
+
+    # keep the library listing serial so its output stays readable
+    if plat == "Darwin":
+        run(["otool", "-L"] + libraries)
+
+    # build output tarball in-process (tar may be missing or MSYS-flavored
+    # on Windows), streaming so archiving overlaps with compression; write
+    # under a temporary name so an interrupted run cannot leave a truncated
+    # artifact that the cached-output check above would trust
+    os.makedirs(output_dir, exist_ok=True)
+    partial = output_tarball + ".tmp"
+    pigz = shutil.which("pigz")
+    if pigz:
+        # compress on all cores, still emitting the same .gz format
+        with open(partial, "wb") as f:
+            process = subprocess.Popen(
+                [pigz, "-p", str(os.cpu_count())], stdin=subprocess.PIPE, stdout=f
+            )
+            with tarfile.open(fileobj=process.stdin, mode="w|") as tar:
+                for name in ("bin", "include", "lib"):
+                    tar.add(os.path.join(dest_dir, name), arcname=name)
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError(f"pigz failed compressing {output_tarball}")
+    else:
+        with tarfile.open(partial, "w:gz", compresslevel=6) as tar:
+            for name in ("bin", "include", "lib"):
+                tar.add(os.path.join(dest_dir, name), arcname=name)
+    os.replace(partial, output_tarball)
@@ -1,5 +1,6 @@
 # Utilities for building native library inside cibuildwheel
 
+import concurrent.futures
 import contextlib
 import os
 import platform
@@ -72,16 +73,42 @@ def log_group(title: str) -> Iterator[None]:
         print(f"::endgroup::\n{ok_str}", flush=True)
 
 
-def make_args(*, parallel: bool) -> list[str]:
+def make_args(*, parallel: bool | int) -> list[str]:
     """
     Arguments for GNU make.
-    """
-    args = []
 
+    `parallel` may be False for a serial build, True to use the job count
+    from the CIBW_BUILD_PARALLEL environment variable (unlimited when it is
+    not set), or an explicit job count.
+    """
+    if parallel is True:
+        jobs = os.environ.get("CIBW_BUILD_PARALLEL")
+        return [f"-j{jobs}"] if jobs else ["-j"]
     if parallel:
-        args.append("-j")
+        return [f"-j{int(parallel)}"]
+    return []
+
 
-    return args
+def fast_copy(src: str, dst: str) -> None:
+    """
+    Copy a file through an in-kernel range copy when the platform offers one
+    (Linux >= 4.5), avoiding the round trip through userspace buffers.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copymode(src, dst)
+                return
+        except OSError:
+            pass
+    shutil.copy(src, dst)
 
 
 def prepend_env(env, name: str, new: str, separator: str = " ") -> None:
@@ -114,16 +141,66 @@ class Package:
     build_system: str = "autoconf"
     build_arguments: list[str] = field(default_factory=list)
     build_dir: str = "build"
-    build_parallel: bool = True
+    build_parallel: bool | int = True
     requires: list[str] = field(default_factory=list)
     source_dir: str = ""
     source_filename: str = ""
     when: When = When.always
 
+    def __post_init__(self) -> None:
+        if not self.source_filename:
+            self.source_filename = self.source_url.rsplit("/", 1)[-1]
+
     def __lt__(self, other):
         return self.name < other.name
 
 
+def build_packages(builder: "Builder", packages: list[Package]) -> None:
+    """
+    Build packages concurrently, respecting their `requires` edges.
+
+    Each build runs in its own process, so chdir and environment changes
+    made while building one package cannot leak into another. Requirements
+    naming tools rather than packages in the list (e.g. "cmake") are
+    assumed to be satisfied already.
+    """
+    names = {package.name for package in packages}
+    pending = {package.name: package for package in packages}
+    done: set[str] = set()
+
+    # sibling builds install into the shared prefix concurrently, so the
+    # per-build diffs taken inside the worker processes overlap and would
+    # record the same file more than once; snapshot the prefix around the
+    # whole phase instead and collect the artifacts in one pass
+    before = builder._installed_files(for_builder=False)
+
+    # each build spawns its own parallel make, so keep the outer pool small
+    # and cap each build's job count so the total stays at the core count;
+    # packages pinning an explicit count (or serial) keep it
+    max_workers = max(1, (os.cpu_count() or 1) // 2)
+    jobs_per_build = max(1, (os.cpu_count() or 1) // max_workers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        running: dict[concurrent.futures.Future, str] = {}
+        while pending or running:
+            for name, package in list(pending.items()):
+                if all(dep in done for dep in package.requires if dep in names):
+                    if package.build_parallel is True:
+                        package = replace(package, build_parallel=jobs_per_build)
+                    running[executor.submit(builder.build, package)] = name
+                    del pending[name]
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                future.result()
+                done.add(running.pop(future))
+
+    builder.artifacts.extend(
+        sorted(builder._installed_files(for_builder=False) - before)
+    )
+
+
 class Builder:
     def __init__(self, dest_dir: str) -> None:
         self._builder_dest_dir = dest_dir + ".builder"
@@ -133,15 +210,25 @@ class Builder:
         self.patch_dir = os.path.abspath("patches")
         self.source_dir = os.path.abspath("source")
 
-    def build(self, package: Package, *, for_builder: bool = False):
-        # if the package is already installed, do nothing
+        # files installed into the prefix by the builds run so far
+        self.artifacts: list[str] = []
+
+    def build(self, package: Package, *, for_builder: bool = False) -> list[str]:
+        """
+        Build and install the package, returning the files it added to the
+        prefix's bin and lib directories.
+        """
+        # if this version of the package is already installed, do nothing
         installed_dir = os.path.join(
             self._prefix(for_builder=for_builder), "var", "lib", "cibuildpkg"
         )
         installed_file = os.path.join(installed_dir, package.name)
         if os.path.exists(installed_file):
-            return
+            with open(installed_file) as fp:
+                if fp.read().strip() == package.sha256:
+                    return []
 
+        before = self._installed_files(for_builder=for_builder)
         with log_group(f"build {package.name}"):
             self._extract(package)
             if package.name == "x265":
@@ -155,10 +242,26 @@ class Builder:
             else:
                 self._build_with_autoconf(package, for_builder=for_builder)
 
-        # mark package as installed
+        # mark package as installed, keyed on the source hash so bumping a
+        # package version invalidates the cached install
         os.makedirs(installed_dir, exist_ok=True)
         with open(installed_file, "w") as fp:
-            fp.write("installed\n")
+            fp.write(package.sha256 + "\n")
+
+        new_files = sorted(self._installed_files(for_builder=for_builder) - before)
+        self.artifacts.extend(new_files)
+        return new_files
+
+    def _installed_files(self, *, for_builder: bool) -> set[str]:
+        prefix = self._prefix(for_builder=for_builder)
+        files: set[str] = set()
+        for subdir in ("bin", "lib"):
+            directory = os.path.join(prefix, subdir)
+            if os.path.isdir(directory):
+                files.update(
+                    os.path.join(directory, name) for name in os.listdir(directory)
+                )
+        return files
 
     def create_directories(self) -> None:
         # print debugging information
@@ -223,10 +326,15 @@ class Builder:
                 script_path = os.path.join(root, name)
                 cache_path = os.path.join(self.source_dir, name)
                 if not os.path.exists(cache_path):
+                    # concurrent builds race to fill this cache on a cold
+                    # run; fetch to a private name and publish atomically so
+                    # no one copies a half-downloaded file
+                    temp_path = f"{cache_path}.{os.getpid()}"
                     fetch(
                         f"https://raw.githubusercontent.com/gcc-mirror/gcc/refs/heads/master/{name}",
-                        cache_path,
+                        temp_path,
                     )
+                    os.replace(temp_path, cache_path)
                 shutil.copy(cache_path, script_path)
                 os.chmod(script_path, 0o755)
 
@@ -331,7 +439,11 @@ class Builder:
                 ["meson", package_source_path] + meson_args + package.build_arguments,
                 env=env,
             )
-            run(["ninja", "--verbose"], env=env)
+            ninja_args = make_args(parallel=package.build_parallel)
+            if ninja_args == ["-j"]:
+                # bare -j is make's "unlimited"; ninja defaults to full width
+                ninja_args = []
+            run(["ninja", "--verbose"] + ninja_args, env=env)
             run(["ninja", "install"], env=env)
 
     def _build_x265(self, package: Package, for_builder: bool) -> None:
@@ -408,10 +520,7 @@ class Builder:
     def _extract(self, package: Package) -> None:
         path = os.path.join(self.build_dir, package.name)
         patch = os.path.join(self.patch_dir, package.name + ".patch")
-        tarball = os.path.join(
-            self.source_dir,
-            package.source_filename or package.source_url.split("/")[-1],
-        )
+        tarball = os.path.join(self.source_dir, package.source_filename)
 
         if not os.path.exists(tarball):
             raise RuntimeError(f"Missing tarbar: {tarball}")